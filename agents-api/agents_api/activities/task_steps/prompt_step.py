@@ -1,61 +1,179 @@
+import asyncio
+import json
+from functools import lru_cache
+from typing import Callable
+
 from beartype import beartype
+from langchain_core.tools import BaseTool
+from langchain_core.tools import tool as tool_decorator
 from litellm.types.utils import ModelResponse
 from temporalio import activity
 from temporalio.exceptions import ApplicationError
+from xxhash import xxh3_64_hexdigest
 
-from ...autogen.openapi_model import Tool
+from ...autogen.openapi_model import SystemDef, Tool
 from ...clients import (
     litellm,  # We dont directly import `acompletion` so we can mock it
 )
 from ...common.protocol.tasks import ExecutionInput, StepContext, StepOutcome
 from ...common.storage_handler import auto_blob_store
 from ...common.utils.template import render_template
-from ...env import debug
+from ...env import debug, litellm_max_concurrency
+from ..utils import get_handler_with_filtered_params
 from .base_evaluate import base_evaluate
 
 COMPUTER_USE_BETA_FLAG = "computer-use-2024-10-22"
 
+# Anthropic's (alpha) computer use tools, these have no function spec
+ANTHROPIC_TOOL_TYPES = frozenset(
+    {"computer_20241022", "text_editor_20241022", "bash_20241022"}
+)
 
-def format_tool(tool: Tool) -> dict:
-    if tool.type == "function":
-        return {
-            "type": "function",
-            "function": {
-                "name": tool.name,
-                "description": tool.description,
-                "parameters": tool.function and tool.function.parameters,
-            },
-        }
+# Prompt step fields that are not completion settings
+EXCLUDED_STEP_KEYS = frozenset(
+    {
+        "prompt",
+        "kind_",
+        "label",
+        "unwrap",
+        "auto_run_tools",
+        "disable_cache",
+        "tools",
+    }
+)
+
+# Bound the number of in-flight completion requests per worker process
+completion_semaphore = asyncio.Semaphore(litellm_max_concurrency)
+
+# In-flight completion requests, keyed by a hash of the request arguments
+inflight_completions: dict[str, asyncio.Task] = {}
+
+
+async def bounded_acompletion(**kwargs) -> ModelResponse:
+    async with completion_semaphore:
+        return await litellm.acompletion(**kwargs)
+
+
+async def coalesced_acompletion(**kwargs) -> ModelResponse:
+    """
+    Shares a single completion request between identical concurrent calls.
+    """
+
+    key = xxh3_64_hexdigest(json.dumps(kwargs, sort_keys=True, default=str))
 
+    if (task := inflight_completions.get(key)) is None:
+        task = asyncio.ensure_future(bounded_acompletion(**kwargs))
+        inflight_completions[key] = task
+        task.add_done_callback(lambda _: inflight_completions.pop(key, None))
+
+    # Shield the shared request so that one caller being cancelled doesn't cancel it for the rest
+    return await asyncio.shield(task)
+
+
+def format_function_tool(tool: Tool) -> dict:
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.name,
+            "description": tool.description,
+            "parameters": tool.function and tool.function.parameters,
+        },
+    }
+
+
+def format_generic_tool(tool: Tool) -> dict:
     # For other tool types, we need to translate them to the OpenAI function tool format
-    formatted = {
+    return {
         "type": "function",
         "function": {"name": tool.name, "description": tool.description},
     }
 
-    # FIXME: Implement system tools
-    # if tool.type == "system":
-    #     handler: Callable = get_handler_with_filtered_params(tool.system)
 
-    #     lc_tool: BaseTool = tool_decorator(handler)
+# System tool params that `execute_system` sets from the execution itself
+SERVER_FILLED_SYSTEM_TOOL_PARAMS = frozenset(
+    {"developer_id", "x_developer_id", "developer"}
+)
+
+
+@lru_cache(maxsize=2048)
+def get_system_tool_schema(
+    resource: str, subresource: str | None, operation: str, description: str | None
+) -> str | None:
+    """
+    Generates the JSON schema of a system tool's handler (as a JSON string).
+
+    Building the LangChain tool is expensive and the handler only depends on
+    the (resource, subresource, operation) triple, so the schema is cached.
+    The schema is cached serialized so that every caller gets its own copy
+    (litellm's provider transforms may modify the tools in place).
+
+    Returns None if no schema can be generated for the system call.
+    """
+
+    try:
+        handler: Callable = get_handler_with_filtered_params(
+            SystemDef(resource=resource, subresource=subresource, operation=operation)
+        )
+
+        # NOTE: LangChain requires a docstring if no description is passed
+        lc_tool: BaseTool = tool_decorator(handler, description=description)
+
+        json_schema: dict = lc_tool.get_input_jsonschema()
+
+    # Not implemented system calls, handlers without a docstring (and no description)
+    # or signatures that can't be serialized to a JSON schema
+    except (NotImplementedError, ValueError, TypeError):
+        return None
+
+    # The developer is always filled in by `execute_system`, the model shouldn't see it
+    for key in SERVER_FILLED_SYSTEM_TOOL_PARAMS:
+        json_schema.get("properties", {}).pop(key, None)
+
+    if "required" in json_schema:
+        json_schema["required"] = [
+            key
+            for key in json_schema["required"]
+            if key not in SERVER_FILLED_SYSTEM_TOOL_PARAMS
+        ]
+
+    return json.dumps(json_schema)
+
+
+def format_system_tool(tool: Tool) -> dict:
+    json_schema_str: str | None = get_system_tool_schema(
+        tool.system.resource,
+        tool.system.subresource,
+        tool.system.operation,
+        tool.description,
+    )
 
-    #     json_schema: dict = lc_tool.get_input_jsonschema()
+    if json_schema_str is None:
+        return format_generic_tool(tool)
 
-    #     formatted["function"]["description"] = formatted["function"][
-    #         "description"
-    #     ] or json_schema.get("description")
+    json_schema: dict = json.loads(json_schema_str)
+
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.name,
+            "description": tool.description or json_schema.get("description"),
+            "parameters": json_schema,
+        },
+    }
 
-    #     formatted["function"]["parameters"] = json_schema
 
-    # # FIXME: Implement integration tools
-    # elif tool.type == "integration":
-    #     raise NotImplementedError("Integration tools are not supported")
+# FIXME: Implement integration tools
+# FIXME: Implement API call tools
 
-    # # FIXME: Implement API call tools
-    # elif tool.type == "api_call":
-    #     raise NotImplementedError("API call tools are not supported")
+# Tool type -> formatter (anything else falls back to `format_generic_tool`)
+tool_formatters: dict[str, Callable[[Tool], dict]] = {
+    "function": format_function_tool,
+    "system": format_system_tool,
+}
 
-    return formatted
+
+def format_tool(tool: Tool) -> dict:
+    return tool_formatters.get(tool.type, format_generic_tool)(tool)
 
 
 EVAL_PROMPT_PREFIX = "$_ "
@@ -66,7 +184,12 @@ EVAL_PROMPT_PREFIX = "$_ "
 @beartype
 async def prompt_step(context: StepContext) -> StepOutcome:
     # Get context data
-    prompt: str | list[dict] = context.current_step.model_dump()["prompt"]
+    # NOTE: Only dump the prompt here; the rest of the step is dumped (with
+    # `exclude_unset`) below, so each field is only serialized once. The prompt
+    # must not use `exclude_unset` since that drops defaulted content part types.
+    prompt: str | list[dict] = context.current_step.model_dump(include={"prompt"})[
+        "prompt"
+    ]
     context_data: dict = await context.prepare_for_step(include_remote=True)
 
     # If the prompt is a string and starts with $_ then we need to evaluate it
@@ -76,7 +199,7 @@ async def prompt_step(context: StepContext) -> StepOutcome:
 
     if should_evaluate_prompt:
         prompt = await base_evaluate(
-            prompt[len(EVAL_PROMPT_PREFIX) :].strip(), context_data
+            prompt.removeprefix(EVAL_PROMPT_PREFIX).strip(), context_data
         )
 
         if not isinstance(prompt, (str, list)):
@@ -114,66 +237,66 @@ async def prompt_step(context: StepContext) -> StepOutcome:
         else "gpt-4o"
     )
 
-    excluded_keys = [
-        "prompt",
-        "kind_",
-        "label",
-        "unwrap",
-        "auto_run_tools",
-        "disable_cache",
-        "tools",
-    ]
-
-    # Get passed settings
-    passed_settings: dict = context.current_step.model_dump(
-        exclude=excluded_keys, exclude_unset=True
+    # Get passed settings (flattening the step's `settings` into the rest)
+    step_settings: dict = context.current_step.model_dump(
+        exclude=EXCLUDED_STEP_KEYS, exclude_unset=True
     )
-    passed_settings.update(passed_settings.pop("settings", {}))
+    inline_settings: dict = step_settings.pop("settings", None) or {}
 
-    if not passed_settings.get("tools"):
-        passed_settings.pop("tool_choice", None)
+    # Remove None values from passed_settings (avoid overwriting agent's settings)
+    passed_settings: dict = {
+        k: v for k, v in (step_settings | inline_settings).items() if v is not None
+    }
 
-    # Format tools for litellm
-    formatted_tools = [format_tool(tool) for tool in context.tools]
+    # Map tool names to their types (all we need to re-convert tool calls)
+    tools_mapping: dict[str, str] = {tool.name: tool.type for tool in context.tools}
 
-    # Map tools to their original objects
-    tools_mapping: dict[str, Tool] = {
-        fmt_tool.get("name") or fmt_tool.get("function", {}).get("name"): orig_tool
-        for fmt_tool, orig_tool in zip(formatted_tools, context.tools)
-    }
+    agent_model_name = agent_model.lower()
 
     # Check if using Claude model and has specific tool types
-    is_claude_model = agent_model.lower().startswith("claude-3.5")
-
-    # FIXME: Hack to make the computer use tools compatible with litellm
-    # Issue was: litellm expects type to be `computer_20241022` and spec to be
-    # `function` (see: https://docs.litellm.ai/docs/providers/anthropic#computer-tools)
-    # but we don't allow that (spec should match type).
-    formatted_tools = []
-    for i, tool in enumerate(context.tools):
-        if tool.type == "computer_20241022" and tool.computer_20241022:
+    is_claude_model = agent_model_name.startswith("claude-3.5")
+
+    # Format tools for litellm
+    formatted_tools: list[dict] = []
+    for tool in context.tools:
+        # FIXME: Hack to make the computer use tools compatible with litellm
+        # Issue was: litellm expects type to be `computer_20241022` and spec to be
+        # `function` (see: https://docs.litellm.ai/docs/providers/anthropic#computer-tools)
+        # but we don't allow that (spec should match type).
+        if (
+            is_claude_model
+            and tool.type == "computer_20241022"
+            and tool.computer_20241022
+        ):
             function = tool.computer_20241022
-            tool = {
-                "type": tool.type,
-                "function": {
-                    "name": tool.name,
-                    "parameters": {
-                        k: v
-                        for k, v in function.model_dump().items()
-                        if k not in ["name", "type"]
+            formatted_tools.append(
+                {
+                    "type": tool.type,
+                    "function": {
+                        "name": tool.name,
+                        "parameters": {
+                            k: v
+                            for k, v in function.model_dump().items()
+                            if k not in ["name", "type"]
+                        },
                     },
-                },
-            }
-            formatted_tools.append(tool)
-    # For non-Claude models, we don't need to send tools
-    # FIXME: Enable formatted_tools once format-tools PR is merged.
-    if not is_claude_model:
-        formatted_tools = None
+                }
+            )
+
+        # The other Anthropic tools can't be sent as function tools
+        elif tool.type in ANTHROPIC_TOOL_TYPES:
+            continue
+
+        else:
+            formatted_tools.append(format_tool(tool))
+
+    # `tool_choice` is only valid when tools are passed
+    if not formatted_tools:
+        passed_settings.pop("tool_choice", None)
 
     # HOTFIX: for groq calls, litellm expects tool_calls_id not to be in the messages
     # FIXME: This is a temporary fix. We need to update the agent-api to use the new tool calling format
-    # FIXME: Enable formatted_tools once format-tools PR is merged.
-    is_groq_model = agent_model.lower().startswith("llama-3.1")
+    is_groq_model = agent_model_name.startswith("llama-3.1")
     if is_groq_model:
         prompt = [
             {
@@ -184,9 +307,6 @@ async def prompt_step(context: StepContext) -> StepOutcome:
             for message in prompt
         ]
 
-    # Remove None values from passed_settings (avoid overwriting agent's settings)
-    passed_settings = {k: v for k, v in passed_settings.items() if v is not None}
-
     # Use litellm for other models
     completion_data: dict = {
         "model": agent_model,
@@ -196,11 +316,15 @@ async def prompt_step(context: StepContext) -> StepOutcome:
         **passed_settings,
     }
 
+    no_cache: bool = debug or context.current_step.disable_cache
     extra_body = {
-        "cache": {"no-cache": debug or context.current_step.disable_cache},
+        "cache": {"no-cache": no_cache},
     }
 
-    response: ModelResponse = await litellm.acompletion(
+    # Identical requests may share a response, unless caching is disabled
+    acompletion = bounded_acompletion if no_cache else coalesced_acompletion
+
+    response: ModelResponse = await acompletion(
         **completion_data,
         extra_body=extra_body,
     )
@@ -227,21 +351,17 @@ async def prompt_step(context: StepContext) -> StepOutcome:
 
             for call in calls:
                 call_name = call["function"]["name"]
-                call_args = call["function"]["arguments"]
 
-                original_tool = tools_mapping.get(call_name)
-                if not original_tool:
+                if call_name not in tools_mapping:
                     raise ApplicationError(f"Tool {call_name} not found")
 
-                if original_tool.type == "function":
+                tool_type = tools_mapping[call_name]
+                if tool_type == "function":
                     continue
 
-                call.pop("function")
-                call["type"] = original_tool.type
-                call[original_tool.type] = {
-                    "name": call_name,
-                    "arguments": call_args,
-                }
+                # Move the `{name, arguments}` dict over to the original tool type
+                call["type"] = tool_type
+                call[tool_type] = call.pop("function")
 
     return StepOutcome(
         output=response_as_dict,
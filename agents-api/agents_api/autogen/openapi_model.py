@@ -1,11 +1,12 @@
 # ruff: noqa: F401, F403, F405
 import ast
+from functools import lru_cache
 from typing import Annotated, Any, Generic, Literal, Self, Type, TypeVar, get_args
 from uuid import UUID
 
 import jinja2
-from litellm.utils import _select_tokenizer as select_tokenizer
-from litellm.utils import token_counter
+from jinja2.nodes import Name as JinjaName
+from jinja2.nodes import Output as JinjaOutput
 from pydantic import (
     AwareDatetime,
     Field,
@@ -120,7 +121,15 @@ PatchToolRequest.type = computed_field(property(type_property))
 # Patch Task Workflow Steps
 # -------------------------
 
+# NOTE: Assigning these validators onto the (already built) generated step models
+# does not register them with pydantic, so they don't run on instantiation. They
+# can't simply be redeclared on subclasses either: nested steps (if/else, switch,
+# foreach branches) are typed with the generated classes and would then fail
+# validation (and pattern matching) against the subclasses.
 
+
+# Pure function of `expr` and the same short expressions recur across steps and tasks
+@lru_cache(maxsize=4096)
 def validate_python_expression(expr: str) -> tuple[bool, str]:
     try:
         ast.parse(expr)
@@ -129,14 +138,23 @@ def validate_python_expression(expr: str) -> tuple[bool, str]:
         return False, f"SyntaxError in '{expr}': {str(e)}"
 
 
+jinja_env = jinja2.Environment()
+
+
+# The same templates get validated over and over (e.g. on every task update),
+# so cache the parsed AST instead of re-lexing and re-parsing them every time
+@lru_cache(maxsize=1024)
+def parse_jinja_template(template: str) -> jinja2.nodes.Template:
+    return jinja_env.parse(template)
+
+
 def validate_jinja_template(template: str) -> tuple[bool, str]:
-    env = jinja2.Environment()
     try:
-        parsed_template = env.parse(template)
+        parsed_template = parse_jinja_template(template)
         for node in parsed_template.body:
-            if isinstance(node, jinja2.nodes.Output):
+            if isinstance(node, JinjaOutput):
                 for child in node.nodes:
-                    if isinstance(child, jinja2.nodes.Name):
+                    if isinstance(child, JinjaName):
                         # Check if the variable is a valid Python expression
                         is_valid, error = validate_python_expression(child.name)
                         if not is_valid:
@@ -298,11 +316,8 @@ CreateTaskRequest.model_config = ConfigDict(
 
 @model_validator(mode="after")
 def validate_subworkflows(self):
-    subworkflows = {
-        k: v
-        for k, v in self.model_dump().items()
-        if k not in _CreateTaskRequest.model_fields
-    }
+    # Subworkflows are the extra (undeclared) fields, no need to dump the whole model
+    subworkflows: dict[str, Any] = dict(self.model_extra or {})
 
     for workflow_name, workflow_definition in subworkflows.items():
         try:
@@ -346,12 +361,6 @@ ExecutionStatus = Execution.model_fields["status"].annotation
 # Extract TransitionType
 TransitionType = Transition.model_fields["type"].annotation
 
-# Assertions to ensure consistency (optional, but recommended for runtime checks)
-assert ChatMLRole == BaseEntry.model_fields["role"].annotation
-assert ChatMLSource == BaseEntry.model_fields["source"].annotation
-assert ExecutionStatus == Execution.model_fields["status"].annotation
-assert TransitionType == Transition.model_fields["type"].annotation
-
 
 # Create models
 # -------------
@@ -372,6 +381,14 @@ class CreateTransitionRequest(Transition):
     task_token: str | None = None
 
 
+# The tokenizer only depends on the model, so don't select it again for every entry
+@lru_cache(maxsize=64)
+def get_tokenizer_type(model: str) -> str:
+    from litellm.utils import _select_tokenizer as select_tokenizer
+
+    return select_tokenizer(model=model)["type"]
+
+
 class CreateEntryRequest(BaseEntry):
     timestamp: Annotated[
         float, Field(ge=0.0, default_factory=lambda: utcnow().timestamp())
@@ -388,7 +405,11 @@ class CreateEntryRequest(BaseEntry):
         source: ChatMLSource,
         **kwargs: dict,
     ) -> Self:
-        tokenizer: dict = select_tokenizer(model=model)
+        # NOTE: litellm is imported lazily since it is slow to import and this
+        # module is imported by everything (api, worker, workflows)
+        from litellm.utils import token_counter
+
+        tokenizer: str = get_tokenizer_type(model)
         token_count = token_counter(
             model=model, messages=[{"role": role, "content": content, "name": name}]
         )
@@ -398,7 +419,7 @@ class CreateEntryRequest(BaseEntry):
             content=content or [],
             name=name,
             source=source,
-            tokenizer=tokenizer["type"],
+            tokenizer=tokenizer,
             token_count=token_count,
             **kwargs,
         )
@@ -1,6 +1,7 @@
 from functools import wraps
 from typing import List, Literal
 
+import httpx
 import litellm
 from beartype import beartype
 from litellm import (
@@ -18,6 +19,8 @@ from ..env import (
     embedding_dimensions,
     embedding_model_id,
     litellm_master_key,
+    litellm_max_connections,
+    litellm_max_keepalive_connections,
     litellm_url,
 )
 
@@ -26,6 +29,18 @@ __all__: List[str] = ["acompletion"]
 # TODO: Should check if this is really needed
 litellm.drop_params = True
 
+# Use an http client with explicit (configurable) connection pool limits for
+# completion calls instead of the OpenAI SDK's default pool. litellm already caches
+# the OpenAI client (and so its keep-alive connections) per api key / base url.
+# NOTE: `follow_redirects` matches the OpenAI SDK's default client
+litellm.aclient_session = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=litellm_max_connections,
+        max_keepalive_connections=litellm_max_keepalive_connections,
+    ),
+    follow_redirects=True,
+)
+
 
 def patch_litellm_response(
     model_response: ModelResponse | CustomStreamWrapper,
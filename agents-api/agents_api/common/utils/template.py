@@ -1,7 +1,9 @@
 import re
+from functools import lru_cache
 from typing import List, TypeVar
 
 from beartype import beartype
+from jinja2 import Template
 from jinja2.sandbox import ImmutableSandboxedEnvironment
 from jinja2schema import infer, to_json_schema
 from jsonschema import validate
@@ -35,6 +37,13 @@ def is_simple_jinja(template_string: str) -> bool:
     return simple_jinja_regex.search(template_string) is None
 
 
+# Compiling a template is much more expensive than rendering it, and the same
+# template strings are rendered over and over again (e.g. prompt steps in loops)
+@lru_cache(maxsize=2048)
+def compile_template(template_string: str) -> Template:
+    return jinja_env.from_string(template_string)
+
+
 # Funcs
 @beartype
 async def render_template_string(
@@ -44,7 +53,7 @@ async def render_template_string(
 ) -> str:
     # Parse template
     # TODO: Check that the string is indeed a jinjd template
-    template = jinja_env.from_string(template_string)
+    template = compile_template(template_string)
 
     # If check is required, get required vars from template and validate variables
     if check:
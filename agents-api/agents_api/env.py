@@ -77,6 +77,11 @@ max_free_executions: int = env.int("MAX_FREE_EXECUTIONS", default=50)
 # -----------
 litellm_url: str = env.str("LITELLM_URL", default="http://0.0.0.0:4000")
 litellm_master_key: str = env.str("LITELLM_MASTER_KEY", default="")
+litellm_max_concurrency: int = env.int("LITELLM_MAX_CONCURRENCY", default=64)
+litellm_max_connections: int = env.int("LITELLM_MAX_CONNECTIONS", default=256)
+litellm_max_keepalive_connections: int = env.int(
+    "LITELLM_MAX_KEEPALIVE_CONNECTIONS", default=128
+)
 
 
 # Embedding service
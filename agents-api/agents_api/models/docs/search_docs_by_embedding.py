@@ -1,6 +1,7 @@
 """This module contains functions for searching documents in the CozoDB based on embedding queries."""
 
 import json
+from functools import lru_cache
 from typing import Any, Literal, TypeVar
 from uuid import UUID
 
@@ -9,7 +10,7 @@ from fastapi import HTTPException
 from pycozo.client import QueryException
 from pydantic import ValidationError
 
-from ...autogen.openapi_model import DocReference
+from ...autogen.openapi_model import DocOwner, DocReference, Snippet
 from ..utils import (
     cozo_query,
     partialclass,
@@ -22,70 +23,42 @@ from ..utils import (
 ModelT = TypeVar("ModelT", bound=Any)
 T = TypeVar("T")
 
+# NOTE: orjson is deliberately optional (it's only installed as a transitive
+# dependency), so fall back to the stdlib encoder if it's not available
+try:
+    import orjson
 
-@rewrap_exceptions(
-    {
-        QueryException: partialclass(HTTPException, status_code=400),
-        ValidationError: partialclass(HTTPException, status_code=400),
-        TypeError: partialclass(HTTPException, status_code=400),
-    }
-)
-@wrap_in_class(
-    DocReference,
-    transform=lambda d: {
-        "owner": {
-            "id": d["owner_id"],
-            "role": d["owner_type"],
-        },
-        "metadata": d.get("metadata", {}),
-        **d,
-    },
-)
-@cozo_query
-@beartype
-def search_docs_by_embedding(
-    *,
-    developer_id: UUID,
-    owners: list[tuple[Literal["user", "agent"], UUID]],
-    query_embedding: list[float],
-    k: int = 3,
-    confidence: float = 0.5,
-    ef: int = 50,
-    embedding_size: int = 1024,
-    ann_threshold: int = 1_000_000,
-    metadata_filter: dict[str, Any] = {},
-) -> tuple[str, dict]:
-    """
-    Searches for document snippets in CozoDB by embedding query.
+    def dumps_json(value: Any) -> str:
+        try:
+            return orjson.dumps(value).decode()
+        except TypeError:
+            # orjson is stricter (e.g. non-str dict keys, big ints)
+            return json.dumps(value)
 
-    Parameters:
-        owner_type (Literal["user", "agent"]): The type of the owner of the documents.
-        owner_id (UUID): The unique identifier of the owner.
-        query_embedding (list[float]): The embedding vector of the query.
-        k (int, optional): The number of nearest neighbors to retrieve. Defaults to 3.
-        confidence (float, optional): The confidence threshold for filtering results. Defaults to 0.8.
-        mmr_lambda (float, optional): The lambda parameter for MMR. Defaults to 0.25.
-        embedding_size (int): Embedding vector length
-        metadata_filter (dict[str, Any]): Dictionary to filter agents based on metadata.
-    """
+except ImportError:
+    dumps_json = json.dumps
 
-    assert len(query_embedding) == embedding_size
-    assert sum(query_embedding)
 
-    metadata_filter_str = ", ".join(
-        [
-            f"metadata->{json.dumps(k)} == {json.dumps(v)}"
-            for k, v in metadata_filter.items()
-        ]
+# NOTE: The items are (key, type, value) so that values that compare (and hash)
+# equal but serialize differently (e.g. `1` and `True`) don't share a cache entry
+@lru_cache(maxsize=512)
+def get_metadata_filter_str(items: tuple[tuple[str, type, Any], ...]) -> str:
+    return ", ".join(
+        f"metadata->{dumps_json(k)} == {dumps_json(v)}" for k, _, v in items
     )
 
-    owners: list[list[str]] = [
-        [owner_type, str(owner_id)] for owner_type, owner_id in owners
-    ]
-
-    # Calculate the search radius based on confidence level
-    radius: float = 1.0 - confidence
 
+# The search query only depends on these scalar params (the owners and the query
+# embedding are passed as query params), so build it once per combination
+@lru_cache(maxsize=256)
+def build_search_query(
+    *,
+    k: int,
+    ef: int,
+    radius: float,
+    ann_threshold: int,
+    metadata_filter_str: str,
+) -> str:
     determine_knn_ann_query = f"""
         owners[owner_type, owner_id] <- $owners
         snippet_counter[count(item)] :=
@@ -343,6 +316,85 @@ def search_docs_by_embedding(
         :sort distance
     """
 
+    return f"""
+        {{ {determine_knn_ann_query} }}
+        {search_query}
+        {{ {normal_interim_query} }}
+        {{ {collect_query} }}
+    """
+
+
+@rewrap_exceptions(
+    {
+        QueryException: partialclass(HTTPException, status_code=400),
+        ValidationError: partialclass(HTTPException, status_code=400),
+        TypeError: partialclass(HTTPException, status_code=400),
+    }
+)
+# The results come straight from the db, so build the models (including the
+# nested ones) without running validation on every row
+@wrap_in_class(
+    DocReference,
+    transform=lambda d: {
+        **d,
+        "id": UUID(d["id"]),
+        "owner": DocOwner.model_construct(
+            id=UUID(d["owner_id"]),
+            role=d["owner_type"],
+        ),
+        "metadata": d.get("metadata", {}),
+        "snippet": Snippet.model_construct(**d["snippet"]),
+    },
+    validate=False,
+)
+@cozo_query
+@beartype
+def search_docs_by_embedding(
+    *,
+    developer_id: UUID,
+    owners: list[tuple[Literal["user", "agent"], UUID]],
+    query_embedding: list[float],
+    k: int = 3,
+    confidence: float = 0.5,
+    ef: int = 50,
+    embedding_size: int = 1024,
+    ann_threshold: int = 1_000_000,
+    metadata_filter: dict[str, Any] = {},
+) -> tuple[str, dict]:
+    """
+    Searches for document snippets in CozoDB by embedding query.
+
+    Parameters:
+        owner_type (Literal["user", "agent"]): The type of the owner of the documents.
+        owner_id (UUID): The unique identifier of the owner.
+        query_embedding (list[float]): The embedding vector of the query.
+        k (int, optional): The number of nearest neighbors to retrieve. Defaults to 3.
+        confidence (float, optional): The confidence threshold for filtering results. Defaults to 0.8.
+        mmr_lambda (float, optional): The lambda parameter for MMR. Defaults to 0.25.
+        embedding_size (int): Embedding vector length
+        metadata_filter (dict[str, Any]): Dictionary to filter agents based on metadata.
+    """
+
+    assert len(query_embedding) == embedding_size
+    assert any(query_embedding)
+
+    metadata_filter_items = tuple(
+        sorted((k, type(v), v) for k, v in metadata_filter.items())
+    )
+
+    try:
+        metadata_filter_str = get_metadata_filter_str(metadata_filter_items)
+    except TypeError:
+        # Unhashable filter values (lists, dicts) can't be cached
+        metadata_filter_str = get_metadata_filter_str.__wrapped__(metadata_filter_items)
+
+    owners_params: list[list[str]] = [
+        [owner_type, str(owner_id)] for owner_type, owner_id in owners
+    ]
+
+    # Calculate the search radius based on confidence level
+    radius: float = 1.0 - confidence
+
     verify_query = "}\n\n{".join(
         [
             verify_developer_id_query(developer_id),
@@ -355,18 +407,23 @@ def search_docs_by_embedding(
         ]
     )
 
+    search_query = build_search_query(
+        k=k,
+        ef=ef,
+        radius=radius,
+        ann_threshold=ann_threshold,
+        metadata_filter_str=metadata_filter_str,
+    )
+
     query = f"""
         {{ {verify_query} }}
-        {{ {determine_knn_ann_query} }}
         {search_query}
-        {{ {normal_interim_query} }}
-        {{ {collect_query} }}
     """
 
     return (
         query,
         {
-            "owners": owners,
+            "owners": owners_params,
             "query_embedding": query_embedding,
         },
     )
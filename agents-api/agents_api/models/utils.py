@@ -465,7 +465,12 @@ def wrap_in_class(
     one: bool = False,
     transform: Callable[[dict], dict] | None = None,
     _kind: str | None = None,
+    validate: bool = True,
 ):
+    # NOTE: Skipping validation is only safe for classes (not arbitrary callables)
+    # and when the (transformed) data is already of the right shape and types
+    construct: Callable[..., ModelT] = cls if validate else cls.model_construct
+
     def _return_data(df: pd.DataFrame):
         # Convert df to list of dicts
         if _kind:
@@ -478,10 +483,10 @@ def wrap_in_class(
 
         if one:
             assert len(data) >= 1, "Expected one result, got none"
-            obj: ModelT = cls(**transform(data[0]))
+            obj: ModelT = construct(**transform(data[0]))
             return obj
 
-        objs: list[ModelT] = [cls(**item) for item in map(transform, data)]
+        objs: list[ModelT] = [construct(**item) for item in map(transform, data)]
         return objs
 
     def decorator(func: Callable[P, pd.DataFrame | Awaitable[pd.DataFrame]]):
@@ -1,10 +1,11 @@
 # Tests for entry queries
 
 import asyncio
+from uuid import UUID
 
 from ward import test
 
-from agents_api.autogen.openapi_model import CreateDocRequest
+from agents_api.autogen.openapi_model import CreateDocRequest, DocOwner, Snippet
 from agents_api.models.docs.create_doc import create_doc
 from agents_api.models.docs.delete_doc import delete_doc
 from agents_api.models.docs.embed_snippets import embed_snippets
@@ -145,6 +146,31 @@ async def _(client=cozo_client, agent=test_agent, developer_id=test_developer_id
     assert len(result) >= 1
     assert result[0].metadata is not None
 
+    # The results are built without validation, so check the types
+    assert isinstance(result[0].id, UUID)
+    assert isinstance(result[0].owner, DocOwner)
+    assert isinstance(result[0].owner.id, UUID)
+    assert isinstance(result[0].snippet, Snippet)
+    assert isinstance(result[0].snippet.index, int)
+
+
+@test("model: search docs by embedding doesn't mix up equal metadata filter values")
+def _(agent=test_agent, developer_id=test_developer_id):
+    def get_query(metadata_filter: dict) -> str:
+        # Only build the query (without running it)
+        query, _ = search_docs_by_embedding.__wrapped__(
+            developer_id=developer_id,
+            owners=[("agent", agent.id)],
+            query_embedding=[1.0] * EMBEDDING_SIZE,
+            metadata_filter=metadata_filter,
+        )
+        return query
+
+    # `1 == True` (and hash the same), but they are different filters
+    assert 'metadata->"flag" == 1' in get_query({"flag": 1})
+    assert 'metadata->"flag" == true' in get_query({"flag": True})
+    assert 'metadata->"flag" == 1' in get_query({"flag": 1})
+
 
 @test("model: embed snippets")
 def _(client=cozo_client, developer_id=test_developer_id, doc=test_doc):
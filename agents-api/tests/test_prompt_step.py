@@ -0,0 +1,316 @@
+import asyncio
+from datetime import datetime, timezone
+from unittest.mock import patch
+from uuid import uuid4
+
+from litellm.types.utils import ModelResponse
+from ward import raises, test
+
+from agents_api.activities.task_steps.prompt_step import (
+    coalesced_acompletion,
+    inflight_completions,
+    prompt_step,
+)
+from agents_api.autogen.openapi_model import (
+    Agent,
+    CreateToolRequest,
+    Execution,
+    PromptStep,
+    TaskSpecDef,
+    TransitionTarget,
+    Workflow,
+)
+from agents_api.common.protocol.tasks import ExecutionInput, StepContext
+
+
+def make_step_context(
+    *,
+    tools: list[CreateToolRequest] = [],
+    model: str = "gpt-4o",
+    **step_kwargs,
+) -> StepContext:
+    now = datetime.now(timezone.utc)
+    task_id = uuid4()
+
+    return StepContext(
+        execution_input=ExecutionInput(
+            developer_id=uuid4(),
+            execution=Execution(
+                id=uuid4(),
+                task_id=task_id,
+                status="running",
+                input={},
+                created_at=now,
+                updated_at=now,
+            ),
+            task=TaskSpecDef(
+                id=task_id,
+                name="test task",
+                tools=[],
+                inherit_tools=True,
+                workflows=[
+                    Workflow(
+                        name="main",
+                        steps=[PromptStep(prompt="Hello", **step_kwargs)],
+                    )
+                ],
+            ),
+            agent=Agent(id=uuid4(), model=model, created_at=now, updated_at=now),
+            agent_tools=tools,
+            arguments={},
+        ),
+        inputs=[{}],
+        cursor=TransitionTarget(workflow="main", step=0),
+    )
+
+
+def make_model_response(message: dict, finish_reason: str = "stop") -> ModelResponse:
+    return ModelResponse(
+        id="fake_id",
+        choices=[dict(message=message, finish_reason=finish_reason)],
+        created=0,
+        object="text_completion",
+    )
+
+
+function_tool = CreateToolRequest(
+    name="get_weather",
+    type="function",
+    description="Get the weather",
+    function={"parameters": {"type": "object", "properties": {}}},
+)
+
+system_tool = CreateToolRequest(
+    name="list_agents",
+    type="system",
+    description="List the agents",
+    system={"resource": "agent", "operation": "list"},
+)
+
+# No handler is implemented for executions
+unsupported_system_tool = CreateToolRequest(
+    name="get_execution",
+    type="system",
+    system={"resource": "execution", "operation": "get"},
+)
+
+bash_tool = CreateToolRequest(
+    name="bash",
+    type="bash_20241022",
+    bash_20241022={"type": "bash_20241022", "name": "bash"},
+)
+
+
+@test("activity: prompt step sends formatted tools and keeps tool_choice")
+async def _():
+    context = make_step_context(
+        tools=[function_tool, system_tool], tool_choice="auto", disable_cache=True
+    )
+
+    with patch("agents_api.clients.litellm.acompletion") as acompletion:
+        acompletion.return_value = make_model_response(
+            {"role": "assistant", "content": "Hi"}
+        )
+        outcome = await prompt_step(context)
+
+    kwargs = acompletion.call_args.kwargs
+    tools = kwargs["tools"]
+
+    assert kwargs["tool_choice"] == "auto"
+    assert [tool["type"] for tool in tools] == ["function", "function"]
+    assert [tool["function"]["name"] for tool in tools] == [
+        "get_weather",
+        "list_agents",
+    ]
+    assert tools[0]["function"]["parameters"] == {"type": "object", "properties": {}}
+    assert tools[1]["function"]["description"] == "List the agents"
+    assert "properties" in tools[1]["function"]["parameters"]
+
+    # The developer id is filled in by the server, not the model
+    system_tool_parameters = tools[1]["function"]["parameters"]
+    for key in ["developer_id", "x_developer_id"]:
+        assert key not in system_tool_parameters["properties"]
+        assert key not in system_tool_parameters.get("required", [])
+    assert outcome.output["choices"][0]["message"]["content"] == "Hi"
+
+
+@test("activity: prompt step drops tool_choice when there are no tools")
+async def _():
+    context = make_step_context(tools=[], tool_choice="auto", disable_cache=True)
+
+    with patch("agents_api.clients.litellm.acompletion") as acompletion:
+        acompletion.return_value = make_model_response(
+            {"role": "assistant", "content": "Hi"}
+        )
+        await prompt_step(context)
+
+    kwargs = acompletion.call_args.kwargs
+
+    assert kwargs["tools"] is None
+    assert "tool_choice" not in kwargs
+
+
+@test("activity: prompt step drops anthropic tools without a function spec")
+async def _():
+    context = make_step_context(
+        tools=[bash_tool], model="claude-3.5-sonnet", disable_cache=True
+    )
+
+    with patch("agents_api.clients.litellm.acompletion") as acompletion:
+        acompletion.return_value = make_model_response(
+            {"role": "assistant", "content": "Hi"}
+        )
+        await prompt_step(context)
+
+    assert acompletion.call_args.kwargs["tools"] is None
+
+
+@test("activity: prompt step converts system tool calls back")
+async def _():
+    context = make_step_context(tools=[function_tool, system_tool], disable_cache=True)
+
+    with patch("agents_api.clients.litellm.acompletion") as acompletion:
+        acompletion.return_value = make_model_response(
+            {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": "call_1",
+                        "type": "function",
+                        "function": {"name": "list_agents", "arguments": "{}"},
+                    },
+                    {
+                        "id": "call_2",
+                        "type": "function",
+                        "function": {"name": "get_weather", "arguments": "{}"},
+                    },
+                ],
+            },
+            finish_reason="tool_calls",
+        )
+        outcome = await prompt_step(context)
+
+    system_call, function_call = outcome.output["choices"][0]["message"]["tool_calls"]
+
+    assert system_call["type"] == "system"
+    assert system_call["system"] == {"name": "list_agents", "arguments": "{}"}
+    assert "function" not in system_call
+
+    assert function_call["type"] == "function"
+    assert function_call["function"]["name"] == "get_weather"
+
+
+@test("activity: prompt step formats unsupported system tools as generic tools")
+async def _():
+    context = make_step_context(tools=[unsupported_system_tool], disable_cache=True)
+
+    with patch("agents_api.clients.litellm.acompletion") as acompletion:
+        acompletion.return_value = make_model_response(
+            {"role": "assistant", "content": "Hi"}
+        )
+        await prompt_step(context)
+
+    assert acompletion.call_args.kwargs["tools"] == [
+        {
+            "type": "function",
+            "function": {"name": "get_execution", "description": None},
+        }
+    ]
+
+
+@test("activity: identical concurrent completions are coalesced")
+async def _():
+    release = asyncio.Event()
+    response = make_model_response({"role": "assistant", "content": "Hi"})
+
+    async def fake_acompletion(**kwargs):
+        await release.wait()
+        return response
+
+    with patch(
+        "agents_api.clients.litellm.acompletion", side_effect=fake_acompletion
+    ) as acompletion:
+        first = asyncio.ensure_future(coalesced_acompletion(model="gpt-4o"))
+        second = asyncio.ensure_future(coalesced_acompletion(model="gpt-4o"))
+        await asyncio.sleep(0)
+
+        assert len(inflight_completions) == 1
+
+        release.set()
+        results = await asyncio.gather(first, second)
+
+    assert acompletion.call_count == 1
+    assert results == [response, response]
+    assert not inflight_completions
+
+
+@test("activity: cancelling one coalesced caller doesn't cancel the others")
+async def _():
+    release = asyncio.Event()
+    response = make_model_response({"role": "assistant", "content": "Hi"})
+
+    async def fake_acompletion(**kwargs):
+        await release.wait()
+        return response
+
+    with patch(
+        "agents_api.clients.litellm.acompletion", side_effect=fake_acompletion
+    ) as acompletion:
+        first = asyncio.ensure_future(coalesced_acompletion(model="gpt-4o"))
+        second = asyncio.ensure_future(coalesced_acompletion(model="gpt-4o"))
+        await asyncio.sleep(0)
+
+        first.cancel()
+        release.set()
+
+        assert await second == response
+
+    assert first.cancelled()
+    assert acompletion.call_count == 1
+    assert not inflight_completions
+
+
+@test("activity: failed coalesced completions are not kept in flight")
+async def _():
+    with patch("agents_api.clients.litellm.acompletion") as acompletion:
+        acompletion.side_effect = ValueError("boom")
+
+        with raises(ValueError):
+            await coalesced_acompletion(model="gpt-4o")
+
+        assert not inflight_completions
+
+        # The next call makes a new request instead of reusing the failed one
+        acompletion.side_effect = None
+        acompletion.return_value = make_model_response(
+            {"role": "assistant", "content": "Hi"}
+        )
+        await coalesced_acompletion(model="gpt-4o")
+
+    assert acompletion.call_count == 2
+    assert not inflight_completions
+
+
+@test("activity: prompt step only coalesces completions when caching is enabled")
+async def _():
+    release = asyncio.Event()
+    response = make_model_response({"role": "assistant", "content": "Hi"})
+
+    async def fake_acompletion(**kwargs):
+        await release.wait()
+        return response
+
+    for disable_cache, expected_calls in [(True, 2), (False, 1)]:
+        context = make_step_context(disable_cache=disable_cache)
+        release.clear()
+
+        with patch(
+            "agents_api.clients.litellm.acompletion", side_effect=fake_acompletion
+        ) as acompletion:
+            steps = asyncio.gather(prompt_step(context), prompt_step(context))
+            await asyncio.sleep(0.1)
+            release.set()
+            await steps
+
+        assert acompletion.call_count == expected_calls